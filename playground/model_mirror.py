@@ -28,7 +28,6 @@ import plotly.express as px
 import plotly as py
 import plotly.graph_objects as go
 from tqdm import tqdm
-from einops import rearrange
 from IPython.display import Video, display, clear_output
 from moviepy.editor import VideoFileClip, TextClip, CompositeVideoClip, clips_array, vfx
 import matplotlib.pyplot as plt 
@@ -59,46 +58,55 @@ path_prefix = '../'
 # %%
 # Define weight-flipping function
 
-def swap_actions(tens, actions_to_swap):
-    act1, act2 = actions_to_swap
-    tens_act1 = tens[models.MAZE_ACTION_INDICES[act1]]
-    tens[models.MAZE_ACTION_INDICES[act1]] = tens[models.MAZE_ACTION_INDICES[act2]]
-    tens[models.MAZE_ACTION_INDICES[act2]] = tens_act1    
+def get_action_perm(flip_x=False, flip_y=False):
+    # Index permutation over the action dim that swaps left/right and/or up/down actions
+    perm = t.arange(len(models.MAZE_ACTIONS_BY_INDEX))
+    for act1, act2, flip in [('LEFT', 'RIGHT', flip_x), ('UP', 'DOWN', flip_y)]:
+        if flip:
+            inds1, inds2 = models.MAZE_ACTION_INDICES[act1], models.MAZE_ACTION_INDICES[act2]
+            perm[inds1 + inds2] = perm[inds2 + inds1]
+    return perm
+
+# Precomputed action permutations for each (flip_x, flip_y)
+ACTION_PERMS = {flip: get_action_perm(*flip) for flip in itertools.product([False, True], repeat=2)}
+
+def get_flip_dims(flip_x=False, flip_y=False):
+    return ((-2,) if flip_y else ()) + ((-1,) if flip_x else ())
+
+# Precomputed pixel permutations of the flattened (128, 8, 8) input to the fc layer, for each (flip_x, flip_y)
+FC_PIXEL_PERMS = {flip: t.flip(t.arange(128*8*8).view(128, 8, 8), dims=get_flip_dims(*flip)).reshape(-1)
+    for flip in itertools.product([False, True], repeat=2)}
 
 def flip_weights_and_actions(policy, flip_x=False, flip_y=False):
-    # Copy network
-    policy_flipped = copy.deepcopy(policy)
+    # Nothing to flip, and callers never modify the returned policy
+    if not flip_x and not flip_y:
+        return policy
+
+    # Copy network, sharing the parameter tensors; every weight we modify below gets a new Parameter
+    policy_flipped = copy.deepcopy(policy, memo={id(p): p for p in policy.parameters()})
 
     # Set up dimensions to flip
-    dims = ((-2,) if flip_y else ()) + ((-1,) if flip_x else ())
+    dims = get_flip_dims(flip_x, flip_y)
 
-    # First, flip all conv kernels
-    for label, mod in policy_flipped.named_modules():
-        if isinstance(mod, nn.Conv2d):
-            with t.no_grad():
+    # Parameters are shared with the original policy, so flipped weights are bound as new
+    # Parameters rather than copied in-place
+    with t.no_grad():
+        # First, flip all conv kernels
+        for label, mod in policy_flipped.named_modules():
+            if isinstance(mod, nn.Conv2d):
                 mod.weight = nn.Parameter(t.flip(mod.weight, dims=dims))
 
-    # Then, the flatten-to-fc weight matrix: flip the pixels that each fc activation uses
-    weight_unflat = rearrange(policy_flipped.embedder.fc.weight, 'd1 (c h w) -> d1 c h w',
-         c=128, h=8)
-    weight_unflat_flip = t.flip(weight_unflat, dims=dims)
-    weight_flip = rearrange(weight_unflat_flip, 'd1 c h w -> d1 (c h w)')
-    with t.no_grad():
+        # Then, the flatten-to-fc weight matrix: flip the pixels that each fc activation uses
+        weight_flip = policy_flipped.embedder.fc.weight.index_select(1, FC_PIXEL_PERMS[(flip_x, flip_y)])
         policy_flipped.embedder.fc.weight = nn.Parameter(weight_flip)
 
-    # Next, the weights and biases of the final logits, to replace the left actions with the right actions
-    weight = policy_flipped.fc_policy.weight.detach().clone()
-    bias = policy_flipped.fc_policy.bias.detach().clone()
-    if flip_x:
-        swap_actions(weight, ['LEFT', 'RIGHT'])
-        swap_actions(bias, ['LEFT', 'RIGHT'])
-    if flip_y:
-        swap_actions(weight, ['UP', 'DOWN'])
-        swap_actions(bias, ['UP', 'DOWN'])
-    with t.no_grad():
+        # Next, the weights and biases of the final logits, to replace the left actions with the right actions
+        perm = ACTION_PERMS[(flip_x, flip_y)]
+        weight = policy_flipped.fc_policy.weight.index_select(0, perm)
+        bias = policy_flipped.fc_policy.bias.index_select(0, perm)
         policy_flipped.fc_policy.weight = nn.Parameter(weight)
         policy_flipped.fc_policy.bias = nn.Parameter(bias)
-    
+
     return policy_flipped
 
 # %%[markdown]
@@ -110,6 +118,7 @@ def flip_weights_and_actions(policy, flip_x=False, flip_y=False):
 # Load model
 rand_region = 5
 policy_normal = models.load_policy(path_prefix + f'trained_models/maze_I/model_rand_region_{rand_region}.pth', 15, t.device('cpu'))
+policy_normal.to(memory_format=t.channels_last)  # get_predict feeds obs in the same layout
 predict_normal = rollout_utils.get_predict(policy_normal)
 
 # %%
@@ -126,15 +135,44 @@ policy_dict = {
 predict_dict = {desc: rollout_utils.get_predict(policy) for desc, policy in policy_dict.items()}
 
 # Test with and without cheese on a specific level, setting the mouse pos in the last run
-display(rollout_utils.side_by_side_rollout(predict_dict, level, False))
-display(rollout_utils.side_by_side_rollout(predict_dict, level, True,  mouse_outer_pos=(11, 11)))
+# (each predict func has its own obs buffer and only reads the shared weights, so rollouts can run in parallel)
+display(rollout_utils.side_by_side_rollout(predict_dict, level, False, parallel=True))
+display(rollout_utils.side_by_side_rollout(predict_dict, level, True,  mouse_outer_pos=(11, 11), parallel=True))
 
 # %%[markdown]
 # Interestingly, the bottom-seeking agents, especially the bottom-right seeking agent, seems to be generally less capable than the other agents.  I hypothesize that this may be caused by some sensitivity to the mouse/cheese icon flipping (the only non-visually-symmetrical objects in the environment as far as I can tell, with the exception of some minor asymmetries in the background pattern.)
 #
 # To see if this is driven by visual stuff only and not some mistaken assumption in the weight modification process, we can test the normal agent, with flipped observations and flipped actions only...
-#
-# TODO: do this!
+
+# %%
+# Normal agent with flipped observations and actions
+
+def get_predict_flipped_obs(policy, flip_x=False, flip_y=False):
+    perm = ACTION_PERMS[(flip_x, flip_y)]
+    def predict(obs, deterministic):
+        # Flip in numpy, which is much faster than t.flip for small images
+        if flip_x:
+            obs = obs[..., ::-1]
+        if flip_y:
+            obs = obs[..., ::-1, :]
+        with t.inference_mode():
+            obs_t = t.from_numpy(np.ascontiguousarray(obs, dtype=np.float32))
+            dist, value = policy(obs_t)
+            # Swap the actions back into the unflipped world
+            logits = dist.logits.index_select(-1, perm)
+            act = rollout_utils.sample_action(logits, deterministic).numpy()
+            return act, None, logits.numpy()
+    return predict
+
+predict_dict_flipped_obs = {
+    'top-left':     get_predict_flipped_obs(policy_normal, flip_x=True, flip_y=False),
+    'top-right':    get_predict_flipped_obs(policy_normal, flip_x=False, flip_y=False),
+    'bottom-left':  get_predict_flipped_obs(policy_normal, flip_x=True,  flip_y=True),
+    'bottom-right': get_predict_flipped_obs(policy_normal, flip_x=False, flip_y=True),
+}
+
+display(rollout_utils.side_by_side_rollout(predict_dict_flipped_obs, level, False))
+display(rollout_utils.side_by_side_rollout(predict_dict_flipped_obs, level, True,  mouse_outer_pos=(11, 11)))
 
 # %%[markdown]
 #
@@ -153,31 +191,33 @@ display(rollout_utils.side_by_side_rollout(predict_dict, level, True,  mouse_out
 # %%
 # Try combining two agents at the logit level
 
+def combine_logits(logits_list: List[t.Tensor]) -> t.Tensor:
+    # Average the logits
+    return t.stack(logits_list).mean(0)
+
 def get_dist_from_policies(policies, obs_t):
     logits_list = []
     for policy in policies:
         hidden = policy.embedder(obs_t)
         logits_list.append(policy.fc_policy(hidden))
-    # Sum the logits
-    logits_comb = rearrange(logits_list, 'p b a -> p b a').mean(axis=0)
+    logits_comb = combine_logits(logits_list)
     log_probs = F.log_softmax(logits_comb, dim=1)
     return Categorical(logits=log_probs)
 
 def get_predict_multi(policies):
     def predict(obs, deterministic):
-        obs_t = t.FloatTensor(obs)
-        dist = get_dist_from_policies(policies, obs_t)
-        if deterministic:
-            act = dist.mode.numpy()
-        else:
-            act = dist.sample().numpy()
-        return act, None, dist.logits.detach().numpy()
+        with t.inference_mode():
+            obs_t = t.FloatTensor(obs)
+            dist = get_dist_from_policies(policies, obs_t)
+            act = rollout_utils.sample_action(dist.logits, deterministic).numpy()
+            return act, None, dist.logits.numpy()
     return predict
 
 def get_forward_multi(policies):
     def forward(obs_t):
-        dist = get_dist_from_policies(policies, obs_t)
-        return dist, None
+        with t.inference_mode():
+            dist = get_dist_from_policies(policies, obs_t)
+            return dist, None
     return forward
 
 def rollout_and_vfield_diff(level, policies_original, policies_patched, desc):
@@ -185,10 +225,12 @@ def rollout_and_vfield_diff(level, policies_original, policies_patched, desc):
     # Rollout
     predict_dict = {'original': get_predict_multi(policies_original),
         'patched': get_predict_multi(policies_patched)}
-    display(rollout_utils.side_by_side_rollout(predict_dict, level))
+    # (the predict funcs hold no state and only read the policy weights, so they're thread-safe)
+    display(rollout_utils.side_by_side_rollout(predict_dict, level, parallel=True))
     # Vfield
     venv = maze.create_venv(1, start_level=level, num_levels=1)
-    policy_hacked = copy.deepcopy(policy_normal)
+    # Only the forward func is replaced, so share the weights with policy_normal
+    policy_hacked = copy.deepcopy(policy_normal, memo={id(p): p for p in policy_normal.parameters()})
     policy_hacked.forward = get_forward_multi(policies_original)
     vf_original = vfield.vector_field(venv, policy_hacked)
     policy_hacked.forward = get_forward_multi(policies_patched)
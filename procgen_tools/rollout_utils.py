@@ -1,26 +1,57 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+import numpy as np
 import torch as t
+import torch.nn as nn
+import torch.nn.functional as F
 from IPython.display import Video
 from moviepy.editor import VideoFileClip, TextClip, CompositeVideoClip, clips_array, vfx
 
 import circrl.rollouts as cro
 import procgen_tools.maze as maze
 
+# Pick actions from a batch of logits
+def sample_action(logits: t.Tensor, deterministic: bool) -> t.Tensor:
+    if deterministic:
+        return logits.argmax(-1)
+    return t.multinomial(F.softmax(logits, dim=-1), 1).squeeze(-1)
+
+# Memory format of the policy's conv weights, so obs can be fed in the same layout
+def _conv_memory_format(plcy):
+    for mod in plcy.modules():
+        if isinstance(mod, nn.Conv2d):
+            if (mod.weight.is_contiguous(memory_format=t.channels_last)
+                    and not mod.weight.is_contiguous()):
+                return t.channels_last
+            break
+    return t.contiguous_format
+
 # Predict func for rollouts
 def get_predict(plcy):
+    # Batched obs arrays are converted into a reused float32 buffer in the same memory format
+    # as the policy's convs, so each step is a single copy; anything else is converted directly
+    memory_format = _conv_memory_format(plcy)
+    obs_buf = None
     def predict(obs, deterministic):
-        #obs = t.flip(t.FloatTensor(obs), dims=(-1,))
-        obs = t.FloatTensor(obs)
-        last_obs = obs
-        dist, value = plcy(obs)
-        if deterministic:
-            act = dist.mode.numpy()
-        else:
-            act = dist.sample().numpy()
-        return act, None, dist.logits.detach().numpy()
+        nonlocal obs_buf
+        with t.inference_mode():
+            if (isinstance(obs, np.ndarray) and obs.ndim == 4
+                    and all(stride >= 0 for stride in obs.strides)):
+                obs = t.from_numpy(obs)
+                if obs_buf is None or obs_buf.shape != obs.shape:
+                    obs_buf = t.empty(obs.shape, dtype=t.float32).contiguous(
+                        memory_format=memory_format)
+                obs = obs_buf.copy_(obs)
+            else:
+                obs = t.as_tensor(np.ascontiguousarray(obs), dtype=t.float32)
+            dist, value = plcy(obs)
+            act = sample_action(dist.logits, deterministic).numpy()
+            return act, None, dist.logits.numpy()
     return predict
 
-# Run rollout and return a video clip
-def rollout_video_clip(predict, level, remove_cheese=False, 
+# Run rollout and return the sequence
+def rollout_seq(predict, level, remove_cheese=False,
         mouse_inner_pos=None,
         mouse_outer_pos=None):
     venv = maze.create_venv(1, start_level=level, num_levels=1)
@@ -38,6 +69,10 @@ def rollout_video_clip(predict, level, remove_cheese=False,
         venv.env.callmethod('set_state', [env_state.state_bytes])
     # Rollout
     seq, _, _ = cro.run_rollout(predict, venv, max_episodes=1, max_steps=256)
+    return seq
+
+# Make a video clip from a rollout sequence
+def seq_video_clip(seq):
     vid_fn, fps = cro.make_video_from_renders(seq.renders)
     rollout_clip = VideoFileClip(vid_fn).margin(10)
     # try:
@@ -48,12 +83,20 @@ def rollout_video_clip(predict, level, remove_cheese=False,
     #     print('Cannot add text overlays, maybe ImageMagick is missing?  Try sudo apt install imagemagick')
     #     final_clip = rollout_clip
     final_clip = rollout_clip
-    return seq, final_clip
+    return final_clip
+
+# Run rollout and return a video clip
+def rollout_video_clip(predict, level, remove_cheese=False, 
+        mouse_inner_pos=None,
+        mouse_outer_pos=None):
+    seq = rollout_seq(predict, level, remove_cheese, mouse_inner_pos, mouse_outer_pos)
+    return seq, seq_video_clip(seq)
 
 # Run rollouts with multiple predict functions, stack the videos side-by-side and return
 def side_by_side_rollout(predicts_dict, levels, remove_cheese=False, num_cols=2,
         mouse_inner_pos=None,
-        mouse_outer_pos=None):
+        mouse_outer_pos=None,
+        parallel=False):
     policy_descs = list(predicts_dict.keys())
     policy_descs_grid = [policy_descs[x:x+num_cols] for x in 
         range(0, len(policy_descs), num_cols)]
@@ -64,14 +107,21 @@ def side_by_side_rollout(predicts_dict, levels, remove_cheese=False, num_cols=2,
         _ = (level for level in levels)
     except TypeError:
         levels = [levels]
-    for level in levels:
-        for desc, predict in predicts_dict.items():
-            seq, clip = rollout_video_clip(predict, level, remove_cheese, mouse_inner_pos,
-                mouse_outer_pos)
-            clips.append(clip)
-            seqs.append(seq)
+    # With parallel=True, the rollouts for each policy run in their own thread (env stepping and
+    # policy inference both release the GIL); only use this if the predict funcs are thread-safe
+    # and don't share a module. Videos are made afterwards, in order.
+    with ThreadPoolExecutor(max_workers=len(predicts_dict) if parallel else 1) as executor:
+        for level in levels:
+            level_seqs = (executor.map if parallel else map)(rollout_seq, predicts_dict.values(),
+                repeat(level), repeat(remove_cheese), repeat(mouse_inner_pos), repeat(mouse_outer_pos))
+            for seq in level_seqs:
+                clips.append(seq_video_clip(seq))
+                seqs.append(seq)
     clips_grid = [clips[x:x+num_cols] for x in range(0, len(clips), num_cols)]
     final_clip = clips_array(clips_grid)
     stacked_fn = 'stacked.mp4'
-    final_clip.resize(width=600).write_videofile(stacked_fn, logger=None)
+    # Fast x264 settings, this video is only for previewing in notebooks
+    final_clip.resize(width=600).write_videofile(stacked_fn, logger=None, codec='libx264',
+        preset='ultrafast', ffmpeg_params=['-crf', '28', '-tune', 'zerolatency'],
+        threads=os.cpu_count())
     return Video(stacked_fn, embed=True), seqs
\ No newline at end of file
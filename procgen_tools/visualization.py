@@ -1167,23 +1167,22 @@ def get_arrows_and_probs(
         action_arrows: A list of lists of probability-weighted basis vectors -- an (x, y) tuple, one for each mouse position
         probs: A list of dicts of action -> probability, one for each mouse position
     """
-    # FIXME: Vectorize this loop. It isn't as critical as the model though
-    action_arrows, probs = [], []
-    for i in range(len(legal_mouse_positions)):
-        # Dict of action -> probability for this mouse position
-        probs_dict = models.human_readable_actions(c_probs[i])
-        # Convert to floats
-        probs_dict = {k: v.item() for k, v in probs_dict.items()}
-
-        # Multiply each basis vector by the probability of that action, and append this list of action component arrows
-        action_arrows.append(
-            [
-                _tmul(models.MAZE_ACTION_DELTAS[act], p)
-                for act, p in probs_dict.items()
-            ]
-        )
-        # Append the {(action : str): (probability : float)} dict
-        probs.append(tuple(probs_dict.values()))
+    # Probability of each action for every mouse position, shape (num_positions, num_actions)
+    probs_dict = models.human_readable_actions(
+        c_probs[: len(legal_mouse_positions)]
+    )
+    probs_arr = (
+        torch.stack(list(probs_dict.values()), dim=-1).cpu().numpy().astype(np.float64)
+    )
+
+    # Multiply each basis vector by the probability of that action, for all positions at once
+    deltas = np.array([models.MAZE_ACTION_DELTAS[act] for act in probs_dict])
+    arrows_arr = probs_arr[:, :, None] * deltas[None, :, :]
+
+    action_arrows = [
+        [tuple(arrow) for arrow in arrows] for arrows in arrows_arr.tolist()
+    ]
+    probs = [tuple(p) for p in probs_arr.tolist()]
 
     return action_arrows, probs
 